@@ -18,20 +18,20 @@ import anki
 import aqt
 import base64
 import hashlib
-import inspect
 import json
+import mmap
 import os
 import os.path
 import re
 import select
 import socket
 import sys
+import threading
 
+from collections import deque, namedtuple
 from operator import itemgetter
 from time import time
 from unicodedata import normalize
-from random import choice
-from string import ascii_letters
 
 #
 # Constants
@@ -39,61 +39,161 @@ from string import ascii_letters
 
 API_VERSION = 6
 API_LOG_PATH = None
+API_LOG_PRETTY = os.getenv('ANKICONNECT_LOG_PRETTY') is not None
+API_LOG_BATCH = 64
 NET_ADDRESS = os.getenv('ANKICONNECT_BIND_ADDRESS', '127.0.0.1')
 NET_BACKLOG = 5
 NET_PORT = 8765
-TICK_INTERVAL = 25
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
 URL_TIMEOUT = 10
 URL_UPGRADE = 'https://raw.githubusercontent.com/FooSoft/anki-connect/master/AnkiConnect.py'
 
 ANKI21 = anki.version.startswith('2.1')
 
+TEMPLATE_FIELD_RE = re.compile(r'\{\{[^#/}]+?\}\}')
+
 #
 # Helpers
 #
 
 if sys.version_info[0] < 3:
     import urllib2
+    from Queue import Queue, Empty, Full
     def download(url):
-        contents = None
         resp = urllib2.urlopen(url, timeout=URL_TIMEOUT)
-        if resp.code == 200:
-            contents = resp.read()
-        return (resp.code, contents)
+        if resp.code != 200:
+            return (resp.code, None)
+
+        def chunks():
+            while True:
+                chunk = resp.read(DOWNLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
 
-    from PyQt4.QtCore import QTimer
+        return (resp.code, chunks())
+
+    from PyQt4.QtCore import QObject, QTimer, pyqtSignal
     from PyQt4.QtGui import QMessageBox
+
+    # minimal stand-in for the Python 3 selectors module
+    EVENT_READ = 1
+    EVENT_WRITE = 2
+
+    SelectorKey = namedtuple('SelectorKey', ['fileobj', 'fd', 'events', 'data'])
+
+    class DefaultSelector:
+        def __init__(self):
+            self.keys = {}
+
+        def register(self, fileobj, events, data=None):
+            key = SelectorKey(fileobj, fileobj.fileno(), events, data)
+            self.keys[fileobj] = key
+            return key
+
+        def unregister(self, fileobj):
+            return self.keys.pop(fileobj)
+
+        def modify(self, fileobj, events, data=None):
+            self.unregister(fileobj)
+            return self.register(fileobj, events, data)
+
+        def select(self, timeout=None):
+            rlist = [key.fileobj for key in self.keys.values() if key.events & EVENT_READ]
+            wlist = [key.fileobj for key in self.keys.values() if key.events & EVENT_WRITE]
+            rready, wready = select.select(rlist, wlist, [], timeout)[:2]
+
+            events = {}
+            for fileobj in rready:
+                events[fileobj] = events.get(fileobj, 0) | EVENT_READ
+            for fileobj in wready:
+                events[fileobj] = events.get(fileobj, 0) | EVENT_WRITE
+
+            return [(self.keys[fileobj], mask) for fileobj, mask in events.items()]
+
+        def close(self):
+            self.keys.clear()
 else:
     unicode = str
 
     from anki.sync import AnkiRequestsClient
     def download(url):
-        contents = None
         client = AnkiRequestsClient()
         client.timeout = URL_TIMEOUT
         resp = client.get(url)
-        if resp.status_code == 200:
-            contents = client.streamContent(resp)
-        return (resp.status_code, contents)
+        if resp.status_code != 200:
+            return (resp.status_code, None)
 
-    from PyQt5.QtCore import QTimer
+        return (resp.status_code, resp.iter_content(DOWNLOAD_CHUNK_SIZE))
+
+    from PyQt5.QtCore import QObject, QTimer, pyqtSignal
     from PyQt5.QtWidgets import QMessageBox
 
+    from selectors import DefaultSelector, EVENT_READ, EVENT_WRITE
+    from queue import Queue, Empty, Full
 
-def makeBytes(data):
-    return data.encode('utf-8')
 
+try:
+    import orjson
+    jsonDumps = orjson.dumps
+    jsonLoads = orjson.loads
+except ImportError:
+    def jsonDumps(obj):
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
 
-def makeStr(data):
-    return data.decode('utf-8')
+    def jsonLoads(data):
+        if isinstance(data, memoryview):
+            data = unicode(data, 'utf-8')
+        return json.loads(data)
 
 
+if hasattr(socket, 'socketpair'):
+    socketpair = socket.socketpair
+else:
+    def socketpair():
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client.connect(listener.getsockname())
+        server = listener.accept()[0]
+        listener.close()
+        return server, client
+
+
+CRLF = b'\r\n'
+CRLF_CRLF = b'\r\n\r\n'
+COLON = b':'
+CONTENT_LENGTH = b'content-length'
+
+
+# SQLite caps a statement at 999 bound parameters; chunking id lists also
+# keeps statement texts short and reusable across calls of similar size
+SQL_CHUNK_SIZE = 500
+
+sqlTemplateCache = {}
+
+def sqlWithPlaceholders(template, count):
+    key = (template, count)
+    sql = sqlTemplateCache.get(key)
+    if sql is None:
+        sql = template.format(','.join(['?'] * count))
+        sqlTemplateCache[key] = sql
+
+    return sql
+
+
+def chunkedIds(ids, size=SQL_CHUNK_SIZE):
+    for index in range(0, len(ids), size):
+        yield ids[index : index + size]
+
+
+apiRegistry = []
+
 def api(*versions):
     def decorator(func):
-        method = lambda *args, **kwargs: func(*args, **kwargs)
-        setattr(method, 'versions', versions)
-        setattr(method, 'api', True)
-        return method
+        apiRegistry.append((func, versions))
+        return func
 
     return decorator
 
@@ -103,8 +203,7 @@ def api(*versions):
 #
 
 class WebRequest:
-    def __init__(self, headers, body):
-        self.headers = headers
+    def __init__(self, body):
         self.body = body
 
 
@@ -113,20 +212,22 @@ class WebRequest:
 #
 
 class WebClient:
-    def __init__(self, sock, handler):
+    def __init__(self, sock, selector, handler):
         self.sock = sock
+        self.fd = sock.fileno()
+        self.selector = selector
         self.handler = handler
-        self.readBuff = bytes()
-        self.writeBuff = bytes()
+        self.readBuff = bytearray()
+        self.writeBuffs = []
+        self.writeHead = 0
+        self.selector.register(sock, EVENT_READ, data=self)
 
 
-    def advance(self, recvSize=1024):
+    def advance(self, events, recvSize=1024):
         if self.sock is None:
             return False
 
-        rlist, wlist = select.select([self.sock], [self.sock], [], 0)[:2]
-
-        if rlist:
+        if events & EVENT_READ:
             msg = self.sock.recv(recvSize)
             if not msg:
                 self.close()
@@ -136,59 +237,120 @@ class WebClient:
 
             req, length = self.parseRequest(self.readBuff)
             if req is not None:
-                self.readBuff = self.readBuff[length:]
-                self.writeBuff += self.handler(req)
+                try:
+                    self.handler(self, req)
+                finally:
+                    req.body.release()
+                del self.readBuff[:length]
+
+        return self.flush()
 
-        if wlist and self.writeBuff:
-            length = self.sock.send(self.writeBuff)
-            self.writeBuff = self.writeBuff[length:]
-            if not self.writeBuff:
+
+    def enqueue(self, buffs):
+        if self.sock is None:
+            return False
+
+        self.writeBuffs += buffs
+        return self.flush()
+
+
+    def flush(self):
+        if self.sock is None:
+            return False
+
+        if self.writeBuffs:
+            buffs = [memoryview(self.writeBuffs[0])[self.writeHead:]] + self.writeBuffs[1:]
+            try:
+                if hasattr(self.sock, 'sendmsg'):
+                    length = self.sock.sendmsg(buffs)
+                else:
+                    length = self.sock.send(buffs[0])
+            except socket.error:
+                length = 0
+
+            length += self.writeHead
+            while self.writeBuffs and length >= len(self.writeBuffs[0]):
+                length -= len(self.writeBuffs[0])
+                self.writeBuffs.pop(0)
+            self.writeHead = length
+
+            if not self.writeBuffs:
                 self.close()
                 return False
 
+            self.selector.modify(self.sock, EVENT_READ | EVENT_WRITE, data=self)
+
         return True
 
 
     def close(self):
         if self.sock is not None:
+            self.selector.unregister(self.sock)
             self.sock.close()
             self.sock = None
 
-        self.readBuff = bytes()
-        self.writeBuff = bytes()
+        self.readBuff = bytearray()
+        self.writeBuffs = []
+        self.writeHead = 0
 
 
     def parseRequest(self, data):
-        parts = data.split(makeBytes('\r\n\r\n'), 1)
-        if len(parts) == 1:
+        index = data.find(CRLF_CRLF)
+        if index == -1:
             return None, 0
 
-        headers = {}
-        for line in parts[0].split(makeBytes('\r\n')):
-            pair = line.split(makeBytes(': '))
-            headers[pair[0].lower()] = pair[1] if len(pair) > 1 else None
-
-        headerLength = len(parts[0]) + 4
-        bodyLength = int(headers.get(makeBytes('content-length'), 0))
+        # scan header lines in place; content-length is the only header used,
+        # so anything whose length or first byte cannot match is skipped
+        # without materializing the header name at all
+        bodyLength = 0
+        start = data.find(CRLF) + 2
+        while 0 <= start < index:
+            end = data.find(CRLF, start, index)
+            if end == -1:
+                end = index
+            colon = data.find(COLON, start, end)
+            if (
+                colon - start == 14 and
+                data[start] | 0x20 == 0x63 and  # 'c' or 'C'
+                bytes(data[start:colon]).lower() == CONTENT_LENGTH
+            ):
+                bodyLength = int(data[colon + 1 : end])
+                break
+            start = end + 2
+
+        headerLength = index + 4
         totalLength = headerLength + bodyLength
 
         if totalLength > len(data):
             return None, 0
 
-        body = data[headerLength : totalLength]
-        return WebRequest(headers, body), totalLength
+        body = memoryview(data)[headerLength : totalLength]
+        return WebRequest(body), totalLength
 
 
 #
 # WebServer
 #
 
-class WebServer:
+class WebServer(QObject):
+    # handing a finished request from the I/O thread to the main thread;
+    # queued automatically because the receiver lives on the main thread
+    requestReady = pyqtSignal(object, object)
+
+
     def __init__(self, handler):
+        QObject.__init__(self)
         self.handler = handler
-        self.clients = []
+        self.selector = DefaultSelector()
+        self.clients = {}
         self.sock = None
+        self.thread = None
+        self.running = False
+        self.wakeRecv = None
+        self.wakeSend = None
+        self.outbox = deque()
         self.resetHeaders()
+        self.requestReady.connect(self.handleRequest)
 
 
     def setHeader(self, name, value):
@@ -212,25 +374,60 @@ class WebServer:
         return headers
 
 
-    def advance(self):
-        if self.sock is not None:
-            self.acceptClients()
-            self.advanceClients()
+    def run(self):
+        # I/O thread: blocks on the selector until a socket or the wakeup
+        # pipe has work, so idle costs nothing and nothing waits for a tick
+        while self.running:
+            for key, events in self.selector.select():
+                data = key.data
+                try:
+                    if data == 'listen':
+                        self.acceptClient()
+                    elif data == 'wake':
+                        self.wakeRecv.recv(1024)
+                    elif not data.advance(events):
+                        self.clients.pop(data.fd, None)
+                except Exception:
+                    # a client aborting mid-request or sending garbage must
+                    # not kill the I/O thread; drop the client and carry on
+                    self.dropClient(data)
+
+            self.drainOutbox()
+
+
+    def drainOutbox(self):
+        while self.outbox:
+            client, buffs = self.outbox.popleft()
+            try:
+                if not client.enqueue(buffs):
+                    self.clients.pop(client.fd, None)
+            except Exception:
+                self.dropClient(client)
 
 
-    def acceptClients(self):
-        rlist = select.select([self.sock], [], [], 0)[0]
-        if not rlist:
-            return
+    def dropClient(self, client):
+        if isinstance(client, WebClient):
+            try:
+                client.close()
+            except Exception:
+                pass
+            self.clients.pop(client.fd, None)
+
+
+    def wake(self):
+        if self.wakeSend is not None:
+            try:
+                self.wakeSend.send(b'\0')
+            except socket.error:
+                pass
 
+
+    def acceptClient(self):
         clientSock = self.sock.accept()[0]
         if clientSock is not None:
             clientSock.setblocking(False)
-            self.clients.append(WebClient(clientSock, self.handlerWrapper))
-
-
-    def advanceClients(self):
-        self.clients = list(filter(lambda c: c.advance(), self.clients))
+            client = WebClient(clientSock, self.selector, self.handlerWrapper)
+            self.clients[client.fd] = client
 
 
     def listen(self):
@@ -241,44 +438,197 @@ class WebServer:
         self.sock.setblocking(False)
         self.sock.bind((NET_ADDRESS, NET_PORT))
         self.sock.listen(NET_BACKLOG)
+        self.selector.register(self.sock, EVENT_READ, data='listen')
+
+        self.wakeRecv, self.wakeSend = socketpair()
+        self.wakeRecv.setblocking(False)
+        self.selector.register(self.wakeRecv, EVENT_READ, data='wake')
 
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
 
-    def handlerWrapper(self, req):
+
+    def handlerWrapper(self, client, req):
+        # I/O thread: JSON decoding happens here so only the action itself
+        # is marshalled to the main thread
         if len(req.body) == 0:
-            body = makeBytes('AnkiConnect v.{}'.format(API_VERSION))
-        else:
-            try:
-                params = json.loads(makeStr(req.body))
-                body = makeBytes(json.dumps(self.handler(params)))
-            except ValueError:
-                body = makeBytes(json.dumps(None))
+            self.sendResponse(client, 'AnkiConnect v.{}'.format(API_VERSION).encode('utf-8'))
+            return
 
-        resp = bytes()
+        try:
+            params = jsonLoads(req.body)
+        except ValueError:
+            self.sendResponse(client, jsonDumps(None))
+            return
+
+        self.requestReady.emit(client, params)
+
+
+    def handleRequest(self, client, params):
+        # main thread: api methods touch Anki's collection, which is not
+        # safe to use from the I/O thread
+        self.sendResponse(client, jsonDumps(self.handler(params)))
 
-        self.setHeader('Content-Length', str(len(body)))
-        headers = self.getHeaders()
 
-        for key, value in headers:
+    def sendResponse(self, client, body):
+        lines = []
+        for key, value in self.getHeaders():
             if value is None:
-                resp += makeBytes('{}\r\n'.format(key))
+                lines.append(key)
             else:
-                resp += makeBytes('{}: {}\r\n'.format(key, value))
+                lines.append('{}: {}'.format(key, value))
+        lines.append('Content-Length: {}'.format(len(body)))
+        lines.append('')
+        lines.append('')
 
-        resp += makeBytes('\r\n')
-        resp += body
-
-        return resp
+        # headers and body stay separate buffers; the client write path
+        # gathers them with sendmsg instead of copying the body again
+        self.outbox.append((client, ['\r\n'.join(lines).encode('utf-8'), body]))
+        self.wake()
 
 
     def close(self):
+        self.running = False
+        if self.thread is not None:
+            self.wake()
+            self.thread.join()
+            self.thread = None
+
         if self.sock is not None:
+            self.selector.unregister(self.sock)
             self.sock.close()
             self.sock = None
 
-        for client in self.clients:
+        if self.wakeRecv is not None:
+            self.selector.unregister(self.wakeRecv)
+            self.wakeRecv.close()
+            self.wakeRecv = None
+
+        if self.wakeSend is not None:
+            self.wakeSend.close()
+            self.wakeSend = None
+
+        for client in self.clients.values():
             client.close()
 
-        self.clients = []
+        self.clients = {}
+        self.outbox.clear()
+
+
+#
+# AddCardsAndClose
+#
+
+class AddCardsAndClose21(aqt.addcards.AddCards):
+    # guiAddCards registers each instance under a unique dialog name and
+    # stashes it here right after aqt.dialogs.open constructs the window
+    windowName = None
+
+
+    def __init__(self, mw):
+        # the window must only reset if
+        # * function `onModelChange` has been called prior
+        # * window was newly opened
+
+        self.modelHasChanged = True
+        super(AddCardsAndClose21, self).__init__(mw)
+
+        self.addButton.setText("Add and Close")
+        self.addButton.setShortcut(aqt.qt.QKeySequence("Ctrl+Return"))
+
+
+    def _addCards(self):
+        super(AddCardsAndClose21, self)._addCards()
+
+        # if adding was successful it must mean it was added to the history of the window
+        if len(self.history):
+            self.reject()
+
+
+    def onModelChange(self):
+        if self.isActiveWindow():
+            super(AddCardsAndClose21, self).onModelChange()
+            self.modelHasChanged = True
+
+
+    def onReset(self, model=None, keep=False):
+        if self.isActiveWindow() or self.modelHasChanged:
+            super(AddCardsAndClose21, self).onReset(model, keep)
+            self.modelHasChanged = False
+
+        else:
+            # modelchoosers text is changed by a reset hook
+            # therefore we need to change it back manually
+            self.modelChooser.models.setText(self.editor.note.model()['name'])
+            self.modelHasChanged = False
+
+
+    def _reject(self):
+        savedMarkClosed = aqt.dialogs.markClosed
+        aqt.dialogs.markClosed = lambda _: savedMarkClosed(self.windowName)
+        super(AddCardsAndClose21, self)._reject()
+        aqt.dialogs.markClosed = savedMarkClosed
+
+        # drop the per-call registration so the dialog registry stays bounded
+        aqt.dialogs._dialogs.pop(self.windowName, None)
+
+
+class AddCardsAndClose20(aqt.addcards.AddCards):
+    windowName = None
+
+
+    def __init__(self, mw):
+        self.modelHasChanged = True
+        super(AddCardsAndClose20, self).__init__(mw)
+
+        self.addButton.setText("Add and Close")
+        self.addButton.setShortcut(aqt.qt.QKeySequence("Ctrl+Return"))
+
+
+    def addCards(self):
+        super(AddCardsAndClose20, self).addCards()
+
+        # if adding was successful it must mean it was added to the history of the window
+        if len(self.history):
+            self.reject()
+
+
+    def onModelChange(self):
+        if self.isActiveWindow():
+            super(AddCardsAndClose20, self).onModelChange()
+            self.modelHasChanged = True
+
+
+    def onReset(self, model=None, keep=False):
+        if self.isActiveWindow() or self.modelHasChanged:
+            super(AddCardsAndClose20, self).onReset(model, keep)
+            self.modelHasChanged = False
+
+        else:
+            # modelchoosers text is changed by a reset hook
+            # therefore we need to change it back manually
+            self.modelChooser.models.setText(self.editor.note.model()['name'])
+            self.modelHasChanged = False
+
+
+    def reject(self):
+        savedClose = aqt.dialogs.close
+        aqt.dialogs.close = lambda _: savedClose(self.windowName)
+        super(AddCardsAndClose20, self).reject()
+        aqt.dialogs.close = savedClose
+
+        # drop the per-call registration so the dialog registry stays bounded
+        aqt.dialogs._dialogs.pop(self.windowName, None)
+
+
+    def setAndFocusNote(self, note):
+        # only Anki 2.1 has this; a no-op here lets callers skip the version check
+        pass
+
+
+AddCardsAndCloseCls = AddCardsAndClose21 if ANKI21 else AddCardsAndClose20
 
 
 #
@@ -286,18 +636,34 @@ class WebServer:
 #
 
 class AnkiConnect:
+    addCardsCounter = 0
+
+
     def __init__(self):
         self.server = WebServer(self.handler)
+        self.buildApiMap()
+        self.modelCache = {}
+        # models are mutated rarely; drop the cache whenever Anki saves one,
+        # and on reset so syncs and GUI profile switches cannot leave stale
+        # model dicts behind
+        anki.hooks.addHook('newModel', self.clearModelCache)
+        anki.hooks.addHook('reset', self.clearModelCache)
+        self.guiCurrentCardCache = None
+        # a new question or a main-window reset means the rendered card
+        # payload is stale
+        anki.hooks.addHook('showQuestion', self.clearGuiCurrentCardCache)
+        anki.hooks.addHook('reset', self.clearGuiCurrentCardCache)
         self.log = None
+        self.logQueue = None
         if API_LOG_PATH is not None:
             self.log = open(API_LOG_PATH, 'w')
+            self.logQueue = Queue(maxsize=1024)
+            logThread = threading.Thread(target=self.logWorker)
+            logThread.daemon = True
+            logThread.start()
 
         try:
             self.server.listen()
-
-            self.timer = QTimer()
-            self.timer.timeout.connect(self.advance)
-            self.timer.start(TICK_INTERVAL)
         except:
             QMessageBox.critical(
                 self.window(),
@@ -306,15 +672,62 @@ class AnkiConnect:
             )
 
 
-    def advance(self):
-        self.server.advance()
+    def buildApiMap(self):
+        self.apiMap = {}
+        for version in range(1, API_VERSION + 1):
+            table = {}
+            for func, versions in apiRegistry:
+                apiVersionLast = 0
+                apiNameLast = None
+
+                for apiVersion, apiName in versions:
+                    if apiVersionLast < apiVersion <= version:
+                        apiVersionLast = apiVersion
+                        apiNameLast = apiName
+
+                if apiNameLast is None and apiVersionLast == 0:
+                    apiNameLast = func.__name__
+
+                if apiNameLast is not None:
+                    table[apiNameLast] = getattr(self, func.__name__)
+
+            self.apiMap[version] = table
+
+
+    def logEvent(self, label, obj):
+        if self.logQueue is not None:
+            try:
+                self.logQueue.put_nowait((label, obj))
+            except Full:
+                pass
+
+
+    def logWorker(self):
+        # drains the log queue off the request path, batching writes so that
+        # formatting and flushing never stall the server
+        while True:
+            items = [self.logQueue.get()]
+            while len(items) < API_LOG_BATCH:
+                try:
+                    items.append(self.logQueue.get_nowait())
+                except Empty:
+                    break
+
+            lines = []
+            for label, obj in items:
+                lines.append('[{}]\n'.format(label))
+                if API_LOG_PRETTY:
+                    lines.append(json.dumps(obj, indent=4, sort_keys=True))
+                else:
+                    lines.append(json.dumps(obj))
+                lines.append('\n\n')
+
+            self.log.writelines(lines)
+            self.log.flush()
 
 
     def handler(self, request):
-        if self.log is not None:
-            self.log.write('[request]\n')
-            json.dump(request, self.log, indent=4, sort_keys=True)
-            self.log.write('\n\n')
+        self.logEvent('request', request)
 
         name = request.get('action', '')
         version = request.get('version', 4)
@@ -322,29 +735,11 @@ class AnkiConnect:
         reply = {'result': None, 'error': None}
 
         try:
-            method = None
-
-            for methodName, methodInst in inspect.getmembers(self, predicate=inspect.ismethod):
-                apiVersionLast = 0
-                apiNameLast = None
-
-                if getattr(methodInst, 'api', False):
-                    for apiVersion, apiName in getattr(methodInst, 'versions', []):
-                        if apiVersionLast < apiVersion <= version:
-                            apiVersionLast = apiVersion
-                            apiNameLast = apiName
-
-                    if apiNameLast is None and apiVersionLast == 0:
-                        apiNameLast = methodName
-
-                    if apiNameLast is not None and apiNameLast == name:
-                        method = methodInst
-                        break
-
+            method = self.apiMap.get(max(1, min(version, API_VERSION)), {}).get(name)
             if method is None:
                 raise Exception('unsupported action')
             else:
-                reply['result'] = methodInst(**params)
+                reply['result'] = method(**params)
 
             if version <= 4:
                 reply = reply['result']
@@ -352,24 +747,30 @@ class AnkiConnect:
         except Exception as e:
             reply['error'] = str(e)
 
-        if self.log is not None:
-            self.log.write('[reply]\n')
-            json.dump(reply, self.log, indent=4, sort_keys=True)
-            self.log.write('\n\n')
-
+        self.logEvent('reply', reply)
         return reply
 
 
-    def download(self, url):
+    def download(self, url, hasher=None):
+        contents = None
         try:
-            (code, contents) = download(url)
+            (code, chunks) = download(url)
+            if code == 200:
+                # hash while downloading instead of making a second pass
+                # over the assembled blob afterwards
+                contents = bytearray()
+                for chunk in chunks:
+                    if hasher is not None:
+                        hasher.update(chunk)
+                    contents += chunk
         except Exception as e:
             raise Exception('{} download failed with error {}'.format(url, str(e)))
-        if code == 200:
-            return contents
-        else:
+
+        if contents is None:
             raise Exception('{} download failed with return code {}'.format(url, code))
 
+        return bytes(contents)
+
 
     def window(self):
         return aqt.mw
@@ -415,6 +816,16 @@ class AnkiConnect:
             return database
 
 
+    def selectChunked(self, template, ids):
+        ids = list(ids)
+        rows = []
+        database = self.database()
+        for chunk in chunkedIds(ids):
+            rows += database.all(sqlWithPlaceholders(template, len(chunk)), *chunk)
+
+        return rows
+
+
     def media(self):
         media = self.collection().media
         if media is None:
@@ -423,6 +834,24 @@ class AnkiConnect:
             return media
 
 
+    def clearModelCache(self):
+        self.modelCache = {}
+
+
+    def clearGuiCurrentCardCache(self):
+        self.guiCurrentCardCache = None
+
+
+    def getModelByName(self, name):
+        model = self.modelCache.get(name)
+        if model is None:
+            model = self.collection().models.byName(name)
+            if model is not None:
+                self.modelCache[name] = model
+
+        return model
+
+
     def startEditing(self):
         self.window().requireReset()
 
@@ -435,7 +864,7 @@ class AnkiConnect:
     def createNote(self, note):
         collection = self.collection()
 
-        model = collection.models.byName(note['modelName'])
+        model = self.getModelByName(note['modelName'])
         if model is None:
             raise Exception('model was not found: {}'.format(note['modelName']))
 
@@ -495,7 +924,7 @@ class AnkiConnect:
                 data = self.download(URL_UPGRADE)
                 path = os.path.splitext(__file__)[0] + '.py'
                 with open(path, 'w') as fp:
-                    fp.write(makeStr(data))
+                    fp.write(data.decode('utf-8'))
                 QMessageBox.information(
                     self.window(),
                     'AnkiConnect',
@@ -513,6 +942,8 @@ class AnkiConnect:
     def loadProfile(self, name):
         if name not in self.window().pm.profiles():
             return False
+        self.clearModelCache()
+        self.clearGuiCurrentCardCache()
         if not self.window().isVisible():
             self.window().pm.load(name)
             self.window().loadProfile()
@@ -530,9 +961,35 @@ class AnkiConnect:
         self.window().onSync()
 
 
+    # read-only actions whose replies may be shared between identical
+    # sub-requests of a single multi() call
+    cacheableActions = {
+        'areDue', 'areSuspended', 'cardsInfo', 'cardsToNotes', 'deckNameFromId',
+        'deckNames', 'deckNamesAndIds', 'findCards', 'findNotes', 'getDeckConfig',
+        'getDecks', 'getIntervals', 'getTags', 'modelFieldNames',
+        'modelFieldsOnTemplates', 'modelNameFromId', 'modelNames',
+        'modelNamesAndIds', 'notesInfo', 'suspended', 'version'
+    }
+
+
     @api()
     def multi(self, actions):
-        return list(map(self.handler, actions))
+        cache = {}
+        results = []
+        for action in actions:
+            name = action.get('action') if isinstance(action, dict) else None
+            if name in self.cacheableActions:
+                key = (name, action.get('version', 4), json.dumps(action.get('params'), sort_keys=True))
+                if key not in cache:
+                    cache[key] = self.handler(action)
+                results.append(cache[key])
+            else:
+                # a mutating action may invalidate any earlier read, so
+                # identical reads after it have to be re-executed
+                cache.clear()
+                results.append(self.handler(action))
+
+        return results
 
 
     #
@@ -547,8 +1004,9 @@ class AnkiConnect:
     @api()
     def deckNamesAndIds(self):
         decks = {}
+        deckManager = self.decks()
         for deck in self.deckNames():
-            decks[deck] = self.decks().id(deck)
+            decks[deck] = deckManager.id(deck)
 
         return decks
 
@@ -556,9 +1014,10 @@ class AnkiConnect:
     @api()
     def getDecks(self, cards):
         decks = {}
-        for card in cards:
-            did = self.database().scalar('select did from cards where id=?', card)
-            deck = self.decks().get(did)['name']
+        deckManager = self.decks()
+        rows = self.selectChunked('select id, did from cards where id in ({})', cards)
+        for card, did in rows:
+            deck = deckManager.get(did)['name']
             if deck in decks:
                 decks[deck].append(card)
             else:
@@ -582,17 +1041,20 @@ class AnkiConnect:
     def changeDeck(self, cards, deck):
         self.startEditing()
 
-        did = self.collection().decks.id(deck)
+        collection = self.collection()
+        did = collection.decks.id(deck)
         mod = anki.utils.intTime()
-        usn = self.collection().usn()
+        usn = collection.usn()
 
-        # normal cards
-        scids = anki.utils.ids2str(cards)
         # remove any cards from filtered deck first
-        self.collection().sched.remFromDyn(cards)
+        collection.sched.remFromDyn(cards)
 
         # then move into new deck
-        self.collection().db.execute('update cards set usn=?, mod=?, did=? where id in ' + scids, usn, mod, did)
+        for chunk in chunkedIds(cards):
+            collection.db.execute(
+                sqlWithPlaceholders('update cards set usn=?, mod=?, did=? where id in ({})', len(chunk)),
+                *([usn, mod, did] + list(chunk))
+            )
         self.stopEditing()
 
 
@@ -600,10 +1062,12 @@ class AnkiConnect:
     def deleteDecks(self, decks, cardsToo=False):
         try:
             self.startEditing()
-            decks = filter(lambda d: d in self.deckNames(), decks)
+            deckNames = set(self.deckNames())
+            deckManager = self.decks()
             for deck in decks:
-                did = self.decks().id(deck)
-                self.decks().rem(did, cardsToo)
+                if deck in deckNames:
+                    did = deckManager.id(deck)
+                    deckManager.rem(did, cardsToo)
         finally:
             self.stopEditing()
 
@@ -637,8 +1101,9 @@ class AnkiConnect:
     @api()
     def setDeckConfigId(self, decks, configId):
         configId = str(configId)
+        deckNames = set(self.deckNames())
         for deck in decks:
-            if not deck in self.deckNames():
+            if deck not in deckNames:
                 return False
 
         collection = self.collection()
@@ -647,7 +1112,7 @@ class AnkiConnect:
 
         for deck in decks:
             did = str(collection.decks.id(deck))
-            aqt.mw.col.decks.decks[did]['conf'] = configId
+            collection.decks.decks[did]['conf'] = configId
 
         return True
 
@@ -655,11 +1120,12 @@ class AnkiConnect:
     @api()
     def cloneDeckConfigId(self, name, cloneFrom='1'):
         configId = str(cloneFrom)
-        if not configId in self.collection().decks.dconf:
+        decks = self.collection().decks
+        if not configId in decks.dconf:
             return False
 
-        config = self.collection().decks.getConf(configId)
-        return self.collection().decks.confId(name, config)
+        config = decks.getConf(configId)
+        return decks.confId(name, config)
 
 
     @api()
@@ -675,7 +1141,9 @@ class AnkiConnect:
 
     @api()
     def storeMediaFile(self, filename, data):
-        self.deleteMediaFile(filename)
+        # only pay for the delete sync roundtrip when the file actually exists
+        if os.path.exists(os.path.join(self.media().dir(), filename)):
+            self.deleteMediaFile(filename)
         self.media().writeData(filename, base64.b64decode(data))
 
 
@@ -688,7 +1156,17 @@ class AnkiConnect:
         path = os.path.join(self.media().dir(), filename)
         if os.path.exists(path):
             with open(path, 'rb') as file:
-                return base64.b64encode(file.read()).decode('ascii')
+                size = os.fstat(file.fileno()).st_size
+                if size == 0:
+                    return ''
+
+                # encode straight from the page cache instead of reading the
+                # whole file into an intermediate bytes object first
+                data = mmap.mmap(file.fileno(), size, access=mmap.ACCESS_READ)
+                try:
+                    return base64.b64encode(data).decode('ascii')
+                finally:
+                    data.close()
 
         return False
 
@@ -698,21 +1176,27 @@ class AnkiConnect:
         self.media().syncDelete(filename)
 
 
-    @api()
-    def addNote(self, note):
+    def addNoteInternal(self, note):
+        # creates and adds a single note; the caller owns the edit session
+        # and the save, so bulk adds pay for both only once
         ankiNote = self.createNote(note)
 
         audio = note.get('audio')
         if audio is not None and len(audio['fields']) > 0:
             try:
-                data = self.download(audio['url'])
+                hasher = None
                 skipHash = audio.get('skipHash')
-                if skipHash is None:
-                    skip = False
-                else:
-                    m = hashlib.md5()
-                    m.update(data)
-                    skip = skipHash == m.hexdigest()
+                if skipHash is not None:
+                    # md5 stays the default for existing callers; blake2b is
+                    # noticeably faster on large downloads where available
+                    algorithm = audio.get('skipHashAlg', 'md5')
+                    if algorithm == 'blake2b' and hasattr(hashlib, 'blake2b'):
+                        hasher = hashlib.blake2b(digest_size=16)
+                    else:
+                        hasher = hashlib.new(algorithm)
+
+                data = self.download(audio['url'], hasher)
+                skip = hasher is not None and skipHash == hasher.hexdigest()
 
                 if not skip:
                     audioFilename = self.media().writeData(audio['filename'], data)
@@ -726,15 +1210,22 @@ class AnkiConnect:
                     if field in ankiNote:
                         ankiNote[field] += errorMessage
 
-        collection = self.collection()
-        self.startEditing()
-        nCardsAdded = collection.addNote(ankiNote)
+        nCardsAdded = self.collection().addNote(ankiNote)
         if nCardsAdded < 1:
             raise Exception('The field values you have provided would make an empty question on all cards.')
+
+        return ankiNote.id
+
+
+    @api()
+    def addNote(self, note):
+        collection = self.collection()
+        self.startEditing()
+        noteId = self.addNoteInternal(note)
         collection.autosave()
         self.stopEditing()
 
-        return ankiNote.id
+        return noteId
 
 
     @api()
@@ -756,6 +1247,9 @@ class AnkiConnect:
                 ankiNote[name] = value
 
         ankiNote.flush()
+        # flushing a note bumps note.mod, not card.mod, and fires no hook,
+        # so the rendered payload has to be dropped by hand
+        self.clearGuiCurrentCardCache()
 
 
     @api()
@@ -777,10 +1271,12 @@ class AnkiConnect:
 
     @api()
     def suspend(self, cards, suspend=True):
-        for card in cards:
-            if self.suspended(card) == suspend:
-                cards.remove(card)
+        alreadySuspended = set(
+            row[0] for row in
+            self.selectChunked('select id from cards where id in ({}) and queue = -1', cards)
+        )
 
+        cards = [card for card in cards if (card in alreadySuspended) != suspend]
         if len(cards) == 0:
             return False
 
@@ -817,14 +1313,31 @@ class AnkiConnect:
 
     @api()
     def areDue(self, cards):
+        latest = {}
+        rows = self.selectChunked('select cid, max(id)/1000.0, ivl from revlog where cid in ({}) group by cid', cards)
+        for cid, date, ivl in rows:
+            latest[cid] = (date, ivl)
+
+        cardInfo = {}
+        rows = self.selectChunked('select id, type, queue, due from cards where id in ({})', cards)
+        for cid, cardType, queue, cardDue in rows:
+            cardInfo[cid] = (cardType, queue, cardDue)
+
+        scheduler = self.scheduler()
         due = []
         for card in cards:
-            if self.findCards('cid:{} is:new'.format(card)):
+            cardType, queue, cardDue = cardInfo[card]
+            if cardType == 0:
                 due.append(True)
             else:
-                date, ivl = self.collection().db.all('select id/1000.0, ivl from revlog where cid = ?', card)[-1]
+                date, ivl = latest[card]
                 if ivl >= -1200:
-                    due.append(bool(self.findCards('cid:{} is:due'.format(card))))
+                    # same classification as Anki's 'is:due' search, without
+                    # re-parsing a search string per card
+                    due.append(
+                        (queue in (2, 3) and cardDue <= scheduler.today) or
+                        (queue == 1 and cardDue <= scheduler.dayCutoff)
+                    )
                 else:
                     due.append(date - ivl <= time())
 
@@ -833,12 +1346,27 @@ class AnkiConnect:
 
     @api()
     def getIntervals(self, cards, complete=False):
+        revlog = {}
+        rows = self.selectChunked('select cid, ivl from revlog where cid in ({}) order by id', cards)
+        for cid, ivl in rows:
+            if cid in revlog:
+                revlog[cid].append(ivl)
+            else:
+                revlog[cid] = [ivl]
+
+        # same classification as Anki's 'is:new' search, without re-parsing
+        # a search string per card
+        newCards = set()
+        for cid, cardType in self.selectChunked('select id, type from cards where id in ({})', cards):
+            if cardType == 0:
+                newCards.add(cid)
+
         intervals = []
         for card in cards:
-            if self.findCards('cid:{} is:new'.format(card)):
+            if card in newCards:
                 intervals.append(0)
             else:
-                interval = self.collection().db.list('select ivl from revlog where cid = ?', card)
+                interval = revlog.get(card, [])
                 if not complete:
                     interval = interval[-1]
                 intervals.append(interval)
@@ -894,7 +1422,7 @@ class AnkiConnect:
     def modelNamesAndIds(self):
         models = {}
         for model in self.modelNames():
-            models[model] = int(self.collection().models.byName(model)['id'])
+            models[model] = int(self.getModelByName(model)['id'])
 
         return models
 
@@ -910,7 +1438,7 @@ class AnkiConnect:
 
     @api()
     def modelFieldNames(self, modelName):
-        model = self.collection().models.byName(modelName)
+        model = self.getModelByName(modelName)
         if model is None:
             raise Exception('model was not found: {}'.format(modelName))
         else:
@@ -919,7 +1447,7 @@ class AnkiConnect:
 
     @api()
     def modelFieldsOnTemplates(self, modelName):
-        model = self.collection().models.byName(modelName)
+        model = self.getModelByName(modelName)
         if model is None:
             raise Exception('model was not found: {}'.format(modelName))
 
@@ -928,16 +1456,16 @@ class AnkiConnect:
             fields = []
             for side in ['qfmt', 'afmt']:
                 fieldsForSide = []
+                questionFields = set(fields[0]) if side == 'afmt' else None
 
                 # based on _fieldsOnTemplate from aqt/clayout.py
-                matches = re.findall('{{[^#/}]+?}}', template[side])
+                matches = TEMPLATE_FIELD_RE.findall(template[side])
                 for match in matches:
                     # remove braces and modifiers
-                    match = re.sub(r'[{}]', '', match)
-                    match = match.split(':')[-1]
+                    match = match[2:-2].split(':')[-1]
 
                     # for the answer side, ignore fields present on the question side + the FrontSide field
-                    if match == 'FrontSide' or side == 'afmt' and match in fields[0]:
+                    if match == 'FrontSide' or side == 'afmt' and match in questionFields:
                         continue
                     fieldsForSide.append(match)
 
@@ -950,11 +1478,13 @@ class AnkiConnect:
 
     @api()
     def deckNameFromId(self, deckId):
+        # not memoized: renaming a deck in the deck browser fires neither
+        # newDeck nor reset, and decks.get is a plain dict lookup anyway
         deck = self.collection().decks.get(deckId)
         if deck is None:
             raise Exception('deck was not found: {}'.format(deckId))
-        else:
-            return deck['name']
+
+        return deck['name']
 
 
     @api()
@@ -1014,6 +1544,14 @@ class AnkiConnect:
 
     @api()
     def notesInfo(self, notes):
+        cardsByNote = {}
+        rows = self.selectChunked('select nid, id from cards where nid in ({}) order by nid, ord', notes)
+        for nid, cid in rows:
+            if nid in cardsByNote:
+                cardsByNote[nid].append(cid)
+            else:
+                cardsByNote[nid] = [cid]
+
         result = []
         for nid in notes:
             try:
@@ -1031,7 +1569,7 @@ class AnkiConnect:
                     'tags' : note.tags,
                     'fields': fields,
                     'modelName': model['name'],
-                    'cards': self.collection().db.list('select id from cards where nid = ? order by ord', note.id)
+                    'cards': cardsByNote.get(note.id, [])
                 })
             except TypeError as e:
                 # Anki will give a TypeError if the note ID does not exist.
@@ -1055,7 +1593,14 @@ class AnkiConnect:
 
     @api()
     def cardsToNotes(self, cards):
-        return self.collection().db.list('select distinct nid from cards where id in ' + anki.utils.ids2str(cards))
+        nids = []
+        seen = set()
+        for row in self.selectChunked('select distinct nid from cards where id in ({})', cards):
+            if row[0] not in seen:
+                seen.add(row[0])
+                nids.append(row[0])
+
+        return nids
 
 
     @api()
@@ -1073,6 +1618,25 @@ class AnkiConnect:
         return browser.model.cards
 
 
+    def applyNoteFieldsAndTags(self, editor, note):
+        ankiNote = editor.note
+
+        if 'fields' in note:
+            changed = False
+            for name, value in note['fields'].items():
+                if name in ankiNote and ankiNote[name] != value:
+                    ankiNote[name] = value
+                    changed = True
+            if changed:
+                # deferring to the event loop lets back-to-back calls
+                # collapse into a single editor refresh
+                QTimer.singleShot(0, editor.loadNote)
+
+        if 'tags' in note:
+            ankiNote.tags = note['tags']
+            QTimer.singleShot(0, editor.updateTags)
+
+
     @api()
     def guiAddCards(self, note=None):
 
@@ -1083,15 +1647,15 @@ class AnkiConnect:
             if deck is None:
                 raise Exception('deck was not found: {}'.format(note['deckName']))
 
-            self.collection().decks.select(deck['id'])
+            collection.decks.select(deck['id'])
             savedMid = deck.pop('mid', None)
 
-            model = collection.models.byName(note['modelName'])
+            model = self.getModelByName(note['modelName'])
             if model is None:
                 raise Exception('model was not found: {}'.format(note['modelName']))
 
-            self.collection().models.setCurrent(model)
-            self.collection().models.update(model)
+            collection.models.setCurrent(model)
+            collection.models.update(model)
 
         closeAfterAdding = False
         if note is not None and 'options' in note:
@@ -1104,141 +1668,43 @@ class AnkiConnect:
 
         if closeAfterAdding:
 
-            randomString = ''.join(choice(ascii_letters) for _ in range(10))
-            windowName = 'AddCardsAndClose' + randomString
+            self.addCardsCounter += 1
+            windowName = 'AddCardsAndClose{}'.format(self.addCardsCounter)
 
-            if ANKI21:
-                class AddCardsAndClose(aqt.addcards.AddCards):
-
-                    def __init__(self, mw):
-                        # the window must only reset if
-                        # * function `onModelChange` has been called prior
-                        # * window was newly opened
-
-                        self.modelHasChanged = True
-                        super().__init__(mw)
-
-                        self.addButton.setText("Add and Close")
-                        self.addButton.setShortcut(aqt.qt.QKeySequence("Ctrl+Return"))
-
-                    def _addCards(self):
-                        super()._addCards()
-
-                        # if adding was successful it must mean it was added to the history of the window
-                        if len(self.history):
-                            self.reject()
-
-                    def onModelChange(self):
-                        if self.isActiveWindow():
-                            super().onModelChange()
-                            self.modelHasChanged = True
-
-                    def onReset(self, model=None, keep=False):
-                        if self.isActiveWindow() or self.modelHasChanged:
-                            super().onReset(model, keep)
-                            self.modelHasChanged = False
-
-                        else:
-                            # modelchoosers text is changed by a reset hook
-                            # therefore we need to change it back manually
-                            self.modelChooser.models.setText(self.editor.note.model()['name'])
-                            self.modelHasChanged = False
-
-                    def _reject(self):
-                        savedMarkClosed = aqt.dialogs.markClosed
-                        aqt.dialogs.markClosed = lambda _: savedMarkClosed(windowName)
-                        super()._reject()
-                        aqt.dialogs.markClosed = savedMarkClosed
-
-            else:
-                class AddCardsAndClose(aqt.addcards.AddCards):
-
-                    def __init__(self, mw):
-                        self.modelHasChanged = True
-                        super(AddCardsAndClose, self).__init__(mw)
-
-                        self.addButton.setText("Add and Close")
-                        self.addButton.setShortcut(aqt.qt.QKeySequence("Ctrl+Return"))
-
-                    def addCards(self):
-                        super(AddCardsAndClose, self).addCards()
-
-                        # if adding was successful it must mean it was added to the history of the window
-                        if len(self.history):
-                            self.reject()
-
-                    def onModelChange(self):
-                        if self.isActiveWindow():
-                            super(AddCardsAndClose, self).onModelChange()
-                            self.modelHasChanged = True
-
-                    def onReset(self, model=None, keep=False):
-                        if self.isActiveWindow() or self.modelHasChanged:
-                            super(AddCardsAndClose, self).onReset(model, keep)
-                            self.modelHasChanged = False
-
-                        else:
-                            self.modelChooser.models.setText(self.editor.note.model()['name'])
-                            self.modelHasChanged = False
-
-                    def reject(self):
-                        savedClose = aqt.dialogs.close
-                        aqt.dialogs.close = lambda _: savedClose(windowName)
-                        super(AddCardsAndClose, self).reject()
-                        aqt.dialogs.close = savedClose
-
-            aqt.dialogs._dialogs[windowName] = [AddCardsAndClose, None]
-            addCards = aqt.dialogs.open(windowName, self.window())
-
-            if savedMid:
-                deck['mid'] = savedMid
+            aqt.dialogs._dialogs[windowName] = [AddCardsAndCloseCls, None]
+            try:
+                addCards = aqt.dialogs.open(windowName, self.window())
+            finally:
+                if savedMid is not None:
+                    deck['mid'] = savedMid
+            addCards.windowName = windowName
 
             editor = addCards.editor
-            ankiNote = editor.note
-
-            if 'fields' in note:
-                for name, value in note['fields'].items():
-                    if name in ankiNote:
-                        ankiNote[name] = value
-                editor.loadNote()
-
-            if 'tags' in note:
-                ankiNote.tags = note['tags']
-                editor.updateTags()
+            self.applyNoteFieldsAndTags(editor, note)
 
-            # if Anki does not Focus, the window will not notice that the
+            # if Anki does not focus, the window will not notice that the
             # fields are actually filled
-            aqt.dialogs.open(windowName, self.window())
-            if ANKI21:
-                addCards.setAndFocusNote(editor.note)
+            addCards.activateWindow()
+            addCards.raise_()
+            addCards.setAndFocusNote(editor.note)
 
         elif note is not None:
             currentWindow = aqt.dialogs._dialogs['AddCards'][1]
 
             def openNewWindow():
-                addCards = aqt.dialogs.open('AddCards', self.window())
-
-                if savedMid:
-                    deck['mid'] = savedMid
-
-                editor = addCards.editor
-                ankiNote = editor.note
+                try:
+                    addCards = aqt.dialogs.open('AddCards', self.window())
+                finally:
+                    if savedMid is not None:
+                        deck['mid'] = savedMid
 
                 # we have to fill out the card in the callback
                 # otherwise we can't assure, the new window is open
-                if 'fields' in note:
-                    for name, value in note['fields'].items():
-                        if name in ankiNote:
-                            ankiNote[name] = value
-                    editor.loadNote()
-
-                if 'tags' in note:
-                    ankiNote.tags = note['tags']
-                    editor.updateTags()
+                editor = addCards.editor
+                self.applyNoteFieldsAndTags(editor, note)
 
                 addCards.activateWindow()
-
-                aqt.dialogs.open('AddCards', self.window())
+                addCards.raise_()
                 if ANKI21:
                     addCards.setAndFocusNote(editor.note)
 
@@ -1257,7 +1723,8 @@ class AnkiConnect:
 
     @api()
     def guiReviewActive(self):
-        return self.reviewer().card is not None and self.window().state == 'review'
+        window = self.window()
+        return window.reviewer.card is not None and window.state == 'review'
 
 
     @api()
@@ -1267,30 +1734,53 @@ class AnkiConnect:
 
         reviewer = self.reviewer()
         card = reviewer.card
-        model = card.model()
-        note = card.note()
+        if card is None:
+            return
 
-        fields = {}
-        for info in model['flds']:
-            order = info['ord']
-            name = info['name']
-            fields[name] = {'value': note.fields[order], 'order': order}
+        # the rendered payload only changes when the card does, but the
+        # endpoint is typically polled; cache everything except the
+        # scheduler-dependent parts
+        cacheKey = (card.id, card.mod)
+        cached = self.guiCurrentCardCache
+        if cached is not None and cached[0] == cacheKey:
+            result = dict(cached[1])
+        else:
+            model = card.model()
+            noteFields = card.note().fields
 
-        if card is not None:
-            buttonList = reviewer._answerButtonList()
-            return {
+            fields = {
+                info['name']: {'value': noteFields[info['ord']], 'order': info['ord']}
+                for info in model['flds']
+            }
+
+            # _getQA re-renders the card template, so call it exactly once
+            qa = card._getQA()
+
+            result = {
                 'cardId': card.id,
                 'fields': fields,
                 'fieldOrder': card.ord,
-                'question': card._getQA()['q'],
-                'answer': card._getQA()['a'],
-                'buttons': [b[0] for b in buttonList],
-                'nextReviews': [reviewer.mw.col.sched.nextIvlStr(reviewer.card, b[0], True) for b in buttonList],
+                'question': qa['q'],
+                'answer': qa['a'],
                 'modelName': model['name'],
                 'deckName': self.deckNameFromId(card.did),
                 'css': model['css'],
                 'template': card.template()['name']
             }
+            self.guiCurrentCardCache = (cacheKey, dict(result))
+
+        scheduler = reviewer.mw.col.sched
+
+        buttons = []
+        nextReviews = []
+        for button in reviewer._answerButtonList():
+            ease = button[0]
+            buttons.append(ease)
+            nextReviews.append(scheduler.nextIvlStr(card, ease, True))
+
+        result['buttons'] = buttons
+        result['nextReviews'] = nextReviews
+        return result
 
 
     @api()
@@ -1319,7 +1809,7 @@ class AnkiConnect:
     @api()
     def guiShowAnswer(self):
         if self.guiReviewActive():
-            self.window().reviewer._showAnswer()
+            self.reviewer()._showAnswer()
             return True
         else:
             return False
@@ -1333,7 +1823,10 @@ class AnkiConnect:
         reviewer = self.reviewer()
         if reviewer.state != 'answer':
             return False
-        if ease <= 0 or ease > self.scheduler().answerButtons(reviewer.card):
+
+        card = reviewer.card
+        maxEase = self.scheduler().answerButtons(card)
+        if not 0 < ease <= maxEase:
             return False
 
         reviewer._answerCard(ease)
@@ -1369,32 +1862,96 @@ class AnkiConnect:
 
     @api()
     def guiExitAnki(self):
-        timer = QTimer()
-        def exitAnki():
-            timer.stop()
-            self.window().close()
-        timer.timeout.connect(exitAnki)
-        timer.start(1000) # 1s should be enough to allow the response to be sent.
+        # the reply is flushed by the server's I/O thread; a short deferral
+        # is enough for it to reach the socket before the window goes down
+        QTimer.singleShot(50, self.window().close)
 
 
 
     @api()
     def addNotes(self, notes):
         results = []
-        for note in notes:
-            try:
-                results.append(self.addNote(note))
-            except Exception:
-                results.append(None)
+        collection = self.collection()
+        self.startEditing()
+        try:
+            for note in notes:
+                try:
+                    results.append(self.addNoteInternal(note))
+                except Exception:
+                    results.append(None)
+        finally:
+            collection.autosave()
+            self.stopEditing()
 
         return results
 
 
     @api()
     def canAddNotes(self, notes):
-        results = []
+        collection = self.collection()
+        decks = collection.decks
+
+        # mirror createNote/dupeOrEmpty per note, but collect the first-field
+        # checksums so duplicates are resolved with one query per model
+        # instead of one per note
+        infos = []
+        csumsByModel = {}
         for note in notes:
-            results.append(self.canAddNote(note))
+            try:
+                model = self.getModelByName(note['modelName'])
+                deck = decks.byName(note['deckName'])
+                if model is None or deck is None:
+                    infos.append(None)
+                    continue
+
+                # createNote reads note['tags'] unconditionally, so a note
+                # without tags cannot be added either
+                if 'tags' not in note:
+                    infos.append(None)
+                    continue
+
+                value = note['fields'].get(model['flds'][0]['name'], '')
+                if not value.strip():
+                    infos.append(None)
+                    continue
+
+                allowDuplicate = False
+                options = note.get('options')
+                if isinstance(options, dict) and 'allowDuplicate' in options:
+                    allowDuplicate = options['allowDuplicate']
+                    if not isinstance(allowDuplicate, bool):
+                        infos.append(None)
+                        continue
+
+                mid = model['id']
+                csum = anki.utils.fieldChecksum(value)
+                infos.append((mid, anki.utils.stripHTMLMedia(value), allowDuplicate))
+                if mid in csumsByModel:
+                    csumsByModel[mid].add(csum)
+                else:
+                    csumsByModel[mid] = {csum}
+            except Exception:
+                infos.append(None)
+
+        existing = {}
+        for mid, csums in csumsByModel.items():
+            firstFields = set()
+            for chunk in chunkedIds(list(csums)):
+                rows = collection.db.list(
+                    sqlWithPlaceholders('select flds from notes where mid = ? and csum in ({})', len(chunk)),
+                    *([mid] + list(chunk))
+                )
+                for flds in rows:
+                    firstFields.add(anki.utils.stripHTMLMedia(anki.utils.splitFields(flds)[0]))
+            existing[mid] = firstFields
+
+        results = []
+        for info in infos:
+            if info is None:
+                results.append(False)
+            else:
+                mid, stripped, allowDuplicate = info
+                results.append(allowDuplicate or stripped not in existing[mid])
 
         return results
 